@@ -1,28 +1,94 @@
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure, OperationFailure
 from dotenv import load_dotenv
+from datetime import datetime, timedelta, timezone
 import os
 
 load_dotenv()
 
+# IndexNotFound, IndexOptionsConflict and IndexKeySpecsConflict: what a worker sees
+# when another worker changed the created_at index at the same time
+INDEX_RACE_ERROR_CODES = (27, 85, 86)
+
 class MongoDB:
     def __init__(self):
         self.client = None
         self.db = None
         self.collection = None
+        self.fs = None
+        self.record_ttl = None
         
-    def connect(self):
+    async def connect(self):
         try:
-            self.client = MongoClient(os.getenv("MONGODB_ATLAS_URI"))
+            self.client = AsyncIOMotorClient(os.getenv("MONGODB_ATLAS_URI"), tz_aware=True)
             self.db = self.client[os.getenv("DATABASE_NAME")]
             self.collection = self.db[os.getenv("COLLECTION_NAME")]
+            # Image binaries live in GridFS, records only keep a reference
+            self.fs = AsyncIOMotorGridFSBucket(self.db)
+            # Listings filter by scanType and page newest-first by created_at
+            await self.collection.create_index([("scanType", ASCENDING), ("created_at", DESCENDING)])
+            # Optionally expire old records; created_at must be a BSON date for this
+            record_ttl = os.getenv("RECORD_TTL_SECONDS")
+            self.record_ttl = int(record_ttl) if record_ttl else None
+            await self.ensure_created_at_index()
             # Test the connection
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
             print("Successfully connected to MongoDB Atlas!")
         except ConnectionFailure as e:
             print(f"Could not connect to MongoDB Atlas: {e}")
             raise
 
+    async def ensure_created_at_index(self):
+        """Create the created_at index, or bring an existing one in line with the TTL setting"""
+        # With several uvicorn workers starting together, another worker may drop or
+        # recreate the index between our check and our change; re-check and retry
+        for attempt in range(3):
+            try:
+                await self._reconcile_created_at_index()
+                return
+            except OperationFailure as e:
+                if e.code not in INDEX_RACE_ERROR_CODES or attempt == 2:
+                    raise
+
+    async def _reconcile_created_at_index(self):
+        existing = (await self.collection.index_information()).get("created_at_1")
+        if existing is not None:
+            current_ttl = existing.get("expireAfterSeconds")
+            if current_ttl == self.record_ttl:
+                return
+            if current_ttl is not None and self.record_ttl is not None:
+                # Only the expiry changed, which collMod can update in place
+                await self.db.command({
+                    "collMod": self.collection.name,
+                    "index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": self.record_ttl}
+                })
+                return
+            # Turning TTL on or off changes the index options, so rebuild it
+            await self.collection.drop_index("created_at_1")
+
+        if self.record_ttl is not None:
+            await self.collection.create_index("created_at", expireAfterSeconds=self.record_ttl)
+        else:
+            await self.collection.create_index("created_at")
+
+    async def purge_expired_images(self):
+        """
+        Delete GridFS images older than the record TTL that no record points to.
+        MongoDB's TTL monitor only removes the records, not their images.
+        """
+        if self.record_ttl is None:
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.record_ttl)
+        cursor = self.db["fs.files"].find({"uploadDate": {"$lt": cutoff}}, projection={"_id": 1})
+        while batch := [doc["_id"] for doc in await cursor.to_list(length=500)]:
+            referenced = set(await self.collection.distinct(
+                "image_file_id", {"image_file_id": {"$in": batch}}
+            ))
+            for file_id in batch:
+                if file_id not in referenced:
+                    await self.fs.delete(file_id)
+
     def close(self):
         if self.client:
             self.client.close()
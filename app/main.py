@@ -1,20 +1,66 @@
-from fastapi import FastAPI, UploadFile, Form, File, HTTPException
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException, Query, WebSocket, WebSocketDisconnect
 from typing import Annotated, Optional
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import asyncio
+import json
+import orjson
 import base64
 from .database import db
 from .models import Medicine, ScanType
-from .schemas import ExtractionResponse
-from .utils import encode_image, get_prompt_by_scan_type, scan_barcode, parse_ai_response, client
-from tempfile import NamedTemporaryFile
+from .schemas import ExtractionResponse, MedicineIn
+from .utils import (
+    OCR_PROMPT, prepare_ocr_image, decode_barcode, scan_barcode,
+    init_barcode_worker, parse_ai_response, JSONFieldStream, client, together_session
+)
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+def dumps_json(content) -> bytes:
+    """Serialize with orjson, falling back to json for values it rejects"""
+    try:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # e.g. integers wider than 64 bits, which the model can emit unquoted
+        return json.dumps(content, default=str).encode()
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson response that also serializes ObjectId and other BSON types"""
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(default_response_class=MongoJSONResponse)
 
-app = FastAPI()
+# GridFS chunk size for saved images (255 KiB, the GridFS default)
+GRIDFS_CHUNK_SIZE = 255 * 1024
+
+# With RECORD_TTL_SECONDS set, how often GridFS images of expired records are reclaimed
+IMAGE_PURGE_INTERVAL = 60 * 60
+image_purge_task = None
+
+# Images encoded ahead of the one being OCR'd on /ws/extract; bounds memory and
+# pushes back on clients that upload faster than the model generates
+WS_PIPELINE_DEPTH = 2
+
+def make_barcode_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    # Start workers from a clean forkserver rather than forking this process,
+    # which already runs Motor and threadpool threads
+    return ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_barcode_worker
+    )
+
+# Barcode decoding is CPU-bound, so it runs on one process per core
+barcode_pool = make_barcode_pool()
 
 # CORS configuration
 app.add_middleware(
@@ -27,69 +73,261 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup_db_client():
-    db.connect()
+    await db.connect()
+
+async def purge_expired_images_periodically():
+    while True:
+        try:
+            await db.purge_expired_images()
+        except Exception as e:
+            print(f"Failed to purge expired images: {e}")
+        await asyncio.sleep(IMAGE_PURGE_INTERVAL)
+
+@app.on_event("startup")
+async def start_image_purge():
+    global image_purge_task
+    if db.record_ttl is not None:
+        image_purge_task = asyncio.create_task(purge_expired_images_periodically())
+
+@app.on_event("shutdown")
+async def stop_image_purge():
+    if image_purge_task:
+        image_purge_task.cancel()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     db.close()
 
+@app.on_event("shutdown")
+async def shutdown_barcode_pool():
+    barcode_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_together_session():
+    together_session.shutdown()
+
+async def open_ocr_stream(base64_image: str):
+    """Start a streamed OCR completion for a base64-encoded JPEG"""
+    # The Together client blocks, so keep it off the event loop
+    return await run_in_threadpool(
+        client.chat.completions.create,
+        model="meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": OCR_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}",
+                        },
+                    },
+                ],
+            }
+        ],
+        stream=True,
+    )
+
+async def ocr_events(stream):
+    """
+    Yield a delta event per model chunk, a field event as each top-level
+    field completes, and finally the parsed result
+    """
+    parts = []
+    fields = JSONFieldStream()
+    while True:
+        chunk = await run_in_threadpool(next, stream, None)
+        if chunk is None:
+            break
+        part = chunk.choices[0].delta.content or "" if chunk.choices else ""
+        if part:
+            parts.append(part)
+            yield {"delta": part}
+            for key, value in fields.feed(part):
+                yield {"field": key, "value": value}
+
+    # Fall back to parsing the whole reply if it was not one clean object
+    result_json = fields.result()
+    if result_json is None:
+        result_json = parse_ai_response("".join(parts))
+    yield {"_final": result_json}
+
+async def stream_extraction(stream):
+    """Forward OCR events as NDJSON lines"""
+    try:
+        async for event in ocr_events(stream):
+            yield dumps_json(event) + b"\n"
+    except Exception as e:
+        # Headers are already sent, so report failures in-band
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+
+async def run_barcode_decode(image_bytes: bytes) -> tuple:
+    """Decode a barcode in the process pool, replacing the pool if a worker died"""
+    global barcode_pool
+    loop = asyncio.get_running_loop()
+    pool = barcode_pool
+    try:
+        return await loop.run_in_executor(pool, decode_barcode, image_bytes)
+    except BrokenProcessPool:
+        # A worker crashed (e.g. zbar on a malformed image, or an OOM kill);
+        # only the first request to notice swaps in a fresh pool
+        if barcode_pool is pool:
+            barcode_pool = make_barcode_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    # Every request in flight on the dead pool fails, not just the one that
+    # crashed it, so retry once in a throwaway single-worker executor; a poison
+    # image can then only kill its own retry, never the shared pool
+    retry_pool = make_barcode_pool(max_workers=1)
+    try:
+        return await loop.run_in_executor(retry_pool, decode_barcode, image_bytes)
+    except BrokenProcessPool:
+        raise ValueError("Barcode scanning failed: the decoder crashed on this image")
+    finally:
+        retry_pool.shutdown(wait=False)
+
 @app.post("/extract")
 async def extract_info(
     scan_type: ScanType,
     file: UploadFile = File(...)
 ):
     """Enhanced extraction endpoint - handles both image OCR and barcode scanning"""
-    # Save uploaded file temporarily
-    with NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        tmp.write(await file.read())
-        image_path = tmp.name
-
     try:
         if scan_type == "image":
-            # Use AI for OCR and text extraction
-            base64_image = encode_image(image_path)
-            prompt = get_prompt_by_scan_type()
+            # Use AI for OCR and text extraction; resizing and encoding are
+            # CPU-bound, so they run in the threadpool rather than on the loop
+            base64_image = await run_in_threadpool(prepare_ocr_image, await file.read())
 
-            stream = client.chat.completions.create(
-                model="meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                },
-                            },
-                        ],
-                    }
-                ],
-                stream=True,
-            )
+            stream = await open_ocr_stream(base64_image)
 
-            output_text = ""
-            for chunk in stream:
-                part = chunk.choices[0].delta.content or "" if chunk.choices else ""
-                output_text += part
+            return StreamingResponse(
+                stream_extraction(stream),
+                media_type="application/x-ndjson"
+            )
 
-            result_json = parse_ai_response(output_text)
-            
         else:  # barcode
-            # Use dedicated barcode scanning
-            result_json = scan_barcode(image_path)
+            # Decode in the process pool, then do the (network) lookup in a thread
+            barcode_data, barcode_type = await run_barcode_decode(await file.read())
+            result_json = await run_in_threadpool(scan_barcode, barcode_data, barcode_type)
 
-        # Clean up
-        os.unlink(image_path)
-
-        return JSONResponse(content=result_json, status_code=200)
+        return result_json
 
     except Exception as e:
-        # Clean up on error
-        if os.path.exists(image_path):
-            os.unlink(image_path)
         raise HTTPException(status_code=500, detail=str(e))
+
+async def insert_record_with_image(record: dict):
+    """Insert a record whose image is already in GridFS, removing the image if the insert fails"""
+    try:
+        await db.collection.insert_one(record)
+    except Exception:
+        try:
+            await db.fs.delete(record["image_file_id"])
+        except Exception as e:
+            print(f"Failed to remove orphaned image {record['image_file_id']}: {e}")
+        raise
+
+async def save_ocr_result(result_json: dict, image_bytes: bytes):
+    """Store an OCR result and its image the same way /save does"""
+    record_id = str(ObjectId())
+    image_file_id = await db.fs.upload_from_stream(
+        f"{record_id}.jpg",
+        image_bytes,
+        chunk_size_bytes=GRIDFS_CHUNK_SIZE,
+        metadata={"content_type": "image/jpeg"}
+    )
+
+    # /save receives form strings, so store extracted values the same way
+    fields = {
+        key: "" if result_json.get(key) is None else str(result_json[key])
+        for key in ("medicineName", "price", "batchNumber", "manufacturingDate", "quantity", "expiryDate")
+    }
+    await insert_record_with_image({
+        "_id": record_id,
+        "id": record_id,
+        **fields,
+        "extractedText": result_json.get("extractedText"),
+        "scanType": ScanType.IMAGE.value,
+        "image_url": f"/images/{record_id}.jpg",
+        "image_file_id": image_file_id,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+@app.websocket("/ws/extract")
+async def extract_info_ws(websocket: WebSocket, save: bool = False):
+    """
+    Pipelined OCR over a WebSocket. Each binary frame is one image; events are
+    sent back as JSON tagged with the image's index. The next image is received
+    and encoded while the model is still generating for the current one, and
+    with save=true each result is stored in the background.
+    """
+    await websocket.accept()
+    queue = asyncio.Queue(maxsize=WS_PIPELINE_DEPTH)
+    pending_saves = set()
+
+    async def send(message: dict):
+        await websocket.send_text(dumps_json(message).decode())
+
+    async def receive_images():
+        index = 0
+        cancelled = False
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                image_bytes = message.get("bytes")
+                try:
+                    if image_bytes is None:
+                        raise ValueError("Expected a binary frame containing an image")
+                    base64_image = await run_in_threadpool(prepare_ocr_image, image_bytes)
+                except Exception as e:
+                    # Report a bad frame in order with the others and keep reading
+                    await queue.put((index, None, None, str(e)))
+                else:
+                    await queue.put((index, image_bytes, base64_image, None))
+                index += 1
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            print(f"WebSocket receive failed: {e}")
+        finally:
+            # Always release the consumer, unless it is the one shutting us down
+            if not cancelled:
+                await queue.put(None)
+
+    async def save_in_background(result_json: dict, image_bytes: bytes):
+        try:
+            await save_ocr_result(result_json, image_bytes)
+        except Exception as e:
+            print(f"Failed to save OCR result: {e}")
+
+    receiver = asyncio.create_task(receive_images())
+    try:
+        while (item := await queue.get()) is not None:
+            index, image_bytes, base64_image, error = item
+            if error:
+                await send({"image": index, "error": error})
+                continue
+            try:
+                stream = await open_ocr_stream(base64_image)
+                async for event in ocr_events(stream):
+                    await send({"image": index, **event})
+                    if save and "_final" in event:
+                        task = asyncio.create_task(save_in_background(event["_final"], image_bytes))
+                        pending_saves.add(task)
+                        task.add_done_callback(pending_saves.discard)
+            except WebSocketDisconnect:
+                break
+            except Exception as e:
+                await send({"image": index, "error": str(e)})
+    finally:
+        receiver.cancel()
+        # Let in-flight saves finish even though the client has gone
+        if pending_saves:
+            await asyncio.gather(*pending_saves, return_exceptions=True)
+
 # @app.post("/extract")
 # async def extract_info(
 #     scan_type: ScanType,
@@ -160,7 +398,7 @@ async def extract_info(
 #         return JSONResponse(content={message: "Barcode image processed data"}, status_code=200)
 
 
-@app.post("/save")
+@app.post("/save", status_code=201)
 async def save_medicine_info(
     medicineName: Annotated[str, Form()],
     price: Annotated[str, Form()],
@@ -174,12 +412,19 @@ async def save_medicine_info(
 ):
     """Endpoint specifically for storing data in database"""
     try:
-        image_data = await image.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        
         record_id = str(ObjectId())
         image_url = f"/images/{record_id}.jpg"
-        current_time = datetime.utcnow().isoformat()
+        current_time = datetime.now(timezone.utc)
+
+        # Stream the spooled upload into GridFS chunk by chunk; Motor reads it
+        # off the event loop, so memory stays bounded by the chunk size
+        await image.seek(0)
+        image_file_id = await db.fs.upload_from_stream(
+            f"{record_id}.jpg",
+            image.file,
+            chunk_size_bytes=GRIDFS_CHUNK_SIZE,
+            metadata={"content_type": image.content_type or "image/jpeg"}
+        )
         
         medicine_record = {
             "_id": record_id,
@@ -192,41 +437,102 @@ async def save_medicine_info(
             "expiryDate": expiryDate,
             "extractedText": extractedText,
             "scanType": scanType.value,  # Ensure it's stored as string
-            "scanDateTime": current_time,  # Frontend expects this field name
             "image_url": image_url,
-            "image_data": base64_image,
-            "created_at": current_time  # Keep this for your backend needs
+            "image_file_id": image_file_id,
+            "created_at": current_time  # BSON date; scanDateTime is derived on read
         }
 
-        db.collection.insert_one(medicine_record)
+        await insert_record_with_image(medicine_record)
 
-        return JSONResponse(
-            content={"status": "success", "id": record_id},
-            status_code=201
-        )
+        return {"status": "success", "id": record_id}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/save/bulk", status_code=201)
+async def save_medicine_info_bulk(records: List[MedicineIn]):
+    """
+    Store many medicine records in a single round-trip. Bulk records have no
+    image, so they are listed with image_url set to null.
+    """
+    if not records:
+        return {"status": "success", "results": []}
 
+    current_time = datetime.now(timezone.utc)
+    docs = []
+    for record in records:
+        record_id = str(ObjectId())
+        docs.append({
+            "_id": record_id,
+            "id": record_id,
+            **record.model_dump(),
+            "scanType": record.scanType.value,
+            "image_url": None,  # Bulk records carry no image
+            "created_at": current_time
+        })
+
+    # Unordered so the server can apply writes in parallel and skip past failures
+    failed = {}
+    try:
+        await db.collection.insert_many(docs, ordered=False)
+    except BulkWriteError as bwe:
+        failed = {err["index"]: err["errmsg"] for err in bwe.details.get("writeErrors", [])}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    results = []
+    for index, doc in enumerate(docs):
+        if index in failed:
+            results.append({"status": "error", "error": failed[index]})
+        else:
+            results.append({"status": "success", "id": doc["_id"]})
+
+    if failed:
+        return MongoJSONResponse(
+            content={"status": "partial", "results": results},
+            status_code=207
+        )
+    return {"status": "success", "results": results}
+
 
 @app.get("/records", response_model=List[Medicine])
-async def get_all_records():
-    """Get all processed medicine items"""
+async def get_all_records(
+    scanType: Optional[ScanType] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Get processed medicine items, newest first, one page at a time"""
     try:
-        items = list(db.collection.find({}))
+        query = {"scanType": scanType.value} if scanType else {}
+        # Leave image references out of the listing, images are served by /images;
+        # _id breaks created_at ties (bulk saves share one timestamp) so pages are stable
+        cursor = db.collection.find(
+            query, projection={"image_data": 0, "image_file_id": 0}
+        ).sort([("created_at", -1), ("_id", -1)]).skip(skip).limit(limit)
+        items = await cursor.to_list(length=limit)
         
         # Convert MongoDB documents to frontend-compatible format
         for item in items:
             if "_id" in item:
                 item["id"] = str(item["_id"])  # Ensure id is string
                 # Keep _id for MongoDB compatibility if needed
+
+            # Records without a created_at date fall back to the ObjectId timestamp
+            if "created_at" not in item and ObjectId.is_valid(item.get("_id")):
+                item["created_at"] = ObjectId(item["_id"]).generation_time
+
+            # Frontend expects scanDateTime; older records stored it as a string
+            if "scanDateTime" not in item and "created_at" in item:
+                item["scanDateTime"] = item["created_at"]
             
             # Ensure scanType is string (not enum)
             if "scanType" in item:
                 item["scanType"] = str(item["scanType"])
                 item["scan_type"] = str(item["scanType"])
         
-        return JSONResponse(content=items, status_code=200)
+        # Returned as a response so stored strings skip Medicine validation
+        return MongoJSONResponse(content=items)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -234,13 +540,36 @@ async def get_all_records():
 @app.get("/images/{image_id}")
 async def get_image(image_id: str):
     try:
-        record = db.collection.find_one({"_id": image_id})
-        if not record or "image_data" not in record:
-            raise HTTPException(status_code=404, detail="Image not found")
-        
-        return Response(
-            content=record["image_data"],
-            media_type="image/jpeg"
+        # image_url is built as /images/{id}.jpg
+        record_id = image_id.removesuffix(".jpg")
+        record = await db.collection.find_one(
+            {"_id": record_id}, projection={"image_file_id": 1, "image_data": 1}
         )
+        if not record:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        if "image_file_id" in record:
+            grid_out = await db.fs.open_download_stream(record["image_file_id"])
+            media_type = (grid_out.metadata or {}).get("content_type", "image/jpeg")
+            return StreamingResponse(iter_gridfs(grid_out), media_type=media_type)
+
+        # Records saved before GridFS kept the image inline as base64
+        if "image_data" in record:
+            return Response(
+                content=base64.b64decode(record["image_data"]),
+                media_type="image/jpeg"
+            )
+
+        raise HTTPException(status_code=404, detail="Image not found")
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def iter_gridfs(grid_out):
+    """Yield a GridFS file chunk by chunk"""
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
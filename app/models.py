@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from typing import Optional
-from datetime import date
+from datetime import date, datetime
 from enum import Enum
 
 class ScanType(str, Enum):
@@ -20,8 +20,8 @@ class MedicineBase(BaseModel):
 
 class Medicine(MedicineBase):
     id: str
-    image_url: str
-    created_at: str
+    image_url: Optional[str] = None
+    created_at: datetime
 
     class Config:
         from_attributes = True
\ No newline at end of file
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from typing import Optional
+from .models import ScanType
 
 class ExtractionResponse(BaseModel):
     medicineName: Optional[str] = None
@@ -9,4 +10,14 @@ class ExtractionResponse(BaseModel):
     batchNumber: Optional[str] = None
     quantity: Optional[int] = None
     image_data: Optional[str] = None
-    extractedText: Optional[str] = None
\ No newline at end of file
+    extractedText: Optional[str] = None
+
+class MedicineIn(BaseModel):
+    medicineName: str
+    price: str
+    batchNumber: str
+    manufacturingDate: str
+    quantity: str
+    expiryDate: str
+    scanType: ScanType
+    extractedText: Optional[str] = None
@@ -1,61 +1,125 @@
 import base64
+import io
 import json
 import re
-from tempfile import NamedTemporaryFile
+import requests
+from functools import lru_cache
+from types import MappingProxyType
+import together
 from together import Together
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import os
+from typing import Optional
 from pyzbar import pyzbar
-from PIL import Image
+from PIL import ExifTags, Image, ImageOps
 import cv2
 import numpy as np
 
 load_dotenv()
 
+class KeepAliveSession(requests.Session):
+    """
+    Session shared by all Together calls. The SDK closes each thread's session
+    once it is a few minutes old, which would drop the shared pool for every
+    thread, so close() is a no-op and shutdown() really closes it.
+    """
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+# The Together SDK sends requests through the requests library and otherwise keeps
+# a separate session per thread; share one pooled keep-alive session instead so
+# calls from any threadpool worker reuse warm TLS connections. urllib3's pool is
+# thread-safe, and the SDK passes headers per request rather than mutating the session
+together_session = KeepAliveSession()
+together_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=2),
+)
+together.requestssession = together_session
+
 client = Together(api_key=os.getenv("TOGETHER_AI_API_KEY"))
 
-def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
-
-def get_prompt_by_scan_type() -> str:
-    return """
-    You are a medicine info extractor:
-    Extract out the following in JSON format only:
-    - medicineName
-    - price
-    - manufacturingDate
-    - expiryDate
-    - batchNumber
-    - quantity
-    - extractedText
-    Do not give any false if it is not found in the given image.
-    Notes and other response also to be put in the JSON object only.
-    Return a valid JSON object that includes all these fields.
-    Only a JSON should be returned by you nothing else.
-    """
-    # else:  # barcode
-    #     return """
-    #     You are a medicine info extractor from barcode:
-    #     Extract out the following in JSON format only:
-    #     - medicineName
-    #     - price
-    #     - manufacturingDate
-    #     - expiryDate
-    #     - batchNumber
-    #     - quantity
-
-    #     Do not include extractedText field.
-    #     Do not give any false if it is not found in the given image.
-    #     Return a valid JSON object that includes all these fields.
-    #     Only a JSON should be returned by you nothing else.
-    #     """
+# Shared session so repeated UPC lookups reuse TCP/TLS connections
+_upc_session = requests.Session()
+
+OCR_PROMPT = (
+    "You are a medicine info extractor:\n"
+    "Extract out the following in JSON format only:\n"
+    "- medicineName\n"
+    "- price\n"
+    "- manufacturingDate\n"
+    "- expiryDate\n"
+    "- batchNumber\n"
+    "- quantity\n"
+    "- extractedText\n"
+    "Do not give any false if it is not found in the given image.\n"
+    "Notes and other response also to be put in the JSON object only.\n"
+    "Return a valid JSON object that includes all these fields.\n"
+    "Only a JSON should be returned by you nothing else.\n"
+)
+
+# Read-only template; copy with dict(_EMPTY_MEDICINE_INFO)
+_EMPTY_MEDICINE_INFO = MappingProxyType({
+    "medicineName": "",
+    "price": "",
+    "manufacturingDate": "",
+    "expiryDate": "",
+    "batchNumber": "",
+    "quantity": ""
+})
+
+# Outermost JSON object in a model reply
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# GS1 Application Identifiers, compiled once; \x1d is the GS1 group separator
+_GS1_PATTERNS = (
+    (re.compile(r'01(\d{14})'), 'gtin'),           # GTIN
+    (re.compile(r'17(\d{6})'), 'expiry'),          # Expiry date (YYMMDD)
+    (re.compile(r'10([^\x1d]+)'), 'batch'),        # Batch/Lot number
+    (re.compile(r'21([^\x1d]+)'), 'serial'),       # Serial number
+    (re.compile(r'30(\d+)'), 'quantity'),          # Quantity
+)
+
+# Longest image edge sent to the vision model; larger images only add tokens
+OCR_MAX_SIDE = 1280
+
+# Longest image edge handed to pyzbar; keeps decode time bounded on big photos
+BARCODE_MAX_SIDE = 1600
+
+def encode_image(image_bytes: bytes) -> str:
+    """Base64-encode raw image bytes"""
+    return base64.b64encode(image_bytes).decode("ascii")
+
+def shrink_image(image_bytes: bytes, max_side: int = OCR_MAX_SIDE) -> bytes:
+    """Downscale an image so its longest edge is at most max_side, as JPEG"""
+    image = Image.open(io.BytesIO(image_bytes))
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    if max(image.size) <= max_side and orientation == 1:
+        return image_bytes
+
+    # Re-encoding drops EXIF, so apply the camera's rotation to the pixels first
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+def prepare_ocr_image(image_bytes: bytes) -> str:
+    """Downscale and base64-encode an upload for the vision model"""
+    return encode_image(shrink_image(image_bytes))
 
 def parse_ai_response(output_text: str) -> dict:
     try:
         result_json = json.loads(output_text)
     except json.JSONDecodeError:
-        match = re.search(r'\{.*\}', output_text, re.DOTALL)
+        match = _JSON_OBJ_RE.search(output_text)
         if match:
             json_text = match.group(0)
             result_json = json.loads(json_text)
@@ -63,80 +127,160 @@ def parse_ai_response(output_text: str) -> dict:
             raise ValueError("Failed to parse JSON response from AI")
     return result_json
 
-def enhance_image_for_barcode(image_path: str) -> str:
-    """Enhance image for better barcode detection"""
-    # Read image
-    img = cv2.imread(image_path)
-    
-    # Convert to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
+class JSONFieldStream:
+    """
+    Incrementally scan a streamed JSON object and report each top-level field
+    as soon as its value is complete. Only unfinished text is kept buffered.
+    """
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self.broken = False
+        self._buffer = ""
+        self._pos = 0
+        self._member_start = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> list:
+        """Consume the next piece of model output; return newly completed (key, value) pairs"""
+        completed = []
+        self._buffer += text
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer) and not self.done:
+            ch = buffer[i]
+            if self._depth == 0:
+                # Skip any preamble (e.g. a ```json fence) before the object opens
+                if ch == '{':
+                    self._depth = 1
+                    self._member_start = i + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    completed += self._close_member(buffer[self._member_start:i])
+                    self.done = True
+            elif ch == ',' and self._depth == 1:
+                completed += self._close_member(buffer[self._member_start:i])
+                self._member_start = i + 1
+            i += 1
+
+        # Drop text that has already been consumed
+        keep_from = self._member_start if self._depth else i
+        self._buffer = buffer[keep_from:]
+        self._pos = i - keep_from
+        self._member_start = 0
+        return completed
+
+    def _close_member(self, member: str) -> list:
+        if not member.strip():
+            return []
+        try:
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            self.broken = True
+            return []
+        self.fields.update(parsed)
+        return list(parsed.items())
+
+    def result(self) -> Optional[dict]:
+        """The parsed object, or None if the stream was not one well-formed object"""
+        if self.done and not self.broken:
+            return self.fields
+        return None
+
+def enhance_image_for_barcode(gray: np.ndarray) -> np.ndarray:
+    """Enhance a grayscale image for better barcode detection"""
     # Apply Gaussian blur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    
-    # Apply adaptive thresholding
-    thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    enhanced = np.empty_like(gray)
+    cv2.GaussianBlur(gray, (5, 5), 0, dst=enhanced)
     
-    # Save enhanced image
-    enhanced_path = image_path.replace('.jpg', '_enhanced.jpg')
-    cv2.imwrite(enhanced_path, thresh)
+    # Apply adaptive thresholding in place on the blurred buffer
+    cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2, dst=enhanced)
     
-    return enhanced_path
+    return enhanced
+
+def init_barcode_worker():
+    """Per-process setup for the barcode decoding pool"""
+    # Each worker decodes one image at a time, so keep OpenCV from oversubscribing cores
+    cv2.setNumThreads(1)
+
+def decode_barcode_image(gray: np.ndarray) -> list:
+    """Run pyzbar on a grayscale image, retrying on an enhanced copy"""
+    # Try with original image first
+    barcodes = pyzbar.decode(gray)
+
+    # If no barcodes found, try with enhanced image
+    if not barcodes:
+        barcodes = pyzbar.decode(enhance_image_for_barcode(gray))
 
-def scan_barcode(image_path: str) -> dict:
-    """Scan barcode from image and return extracted data"""
+    return barcodes
+
+def decode_barcode(image_bytes: bytes) -> tuple:
+    """Decode the first barcode in an image; runs in a worker process"""
     try:
-        # Try with original image first
-        image = Image.open(image_path)
-        barcodes = pyzbar.decode(image)
-        
-        # If no barcodes found, try with enhanced image
+        # Decode straight to grayscale, which is all pyzbar needs
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError("Could not read image")
+
+        # Try a downscaled copy of large photos first since it decodes faster
+        barcodes = []
+        longest = max(gray.shape)
+        if longest > BARCODE_MAX_SIDE:
+            scale = BARCODE_MAX_SIDE / longest
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            barcodes = decode_barcode_image(small)
+
+        # Small codes can lose their narrowest bars when downscaled, so fall
+        # back to the full-resolution image
         if not barcodes:
-            enhanced_path = enhance_image_for_barcode(image_path)
-            enhanced_image = Image.open(enhanced_path)
-            barcodes = pyzbar.decode(enhanced_image)
-            # Clean up enhanced image
-            if os.path.exists(enhanced_path):
-                os.unlink(enhanced_path)
+            barcodes = decode_barcode_image(gray)
         
         if not barcodes:
             raise ValueError("No barcode detected in the image")
         
         # Process the first barcode found
         barcode = barcodes[0]
-        barcode_data = barcode.data.decode('utf-8')
-        barcode_type = barcode.type
-        
-        # Try to get medicine info from barcode data
-        medicine_info = get_medicine_info_from_barcode(barcode_data, barcode_type)
-        
-        return {
-            "medicineName": medicine_info.get("medicineName", ""),
-            "price": medicine_info.get("price", ""),
-            "manufacturingDate": medicine_info.get("manufacturingDate", ""),
-            "expiryDate": medicine_info.get("expiryDate", ""),
-            "batchNumber": medicine_info.get("batchNumber", ""),
-            "quantity": medicine_info.get("quantity", ""),
-            "barcodeData": barcode_data,
-            "barcodeType": barcode_type
-        }
+        return barcode.data.decode('utf-8'), barcode.type
         
     except Exception as e:
         raise ValueError(f"Barcode scanning failed: {str(e)}")
 
+def scan_barcode(barcode_data: str, barcode_type: str) -> dict:
+    """Look up medicine info for a decoded barcode and return extracted data"""
+    # Try to get medicine info from barcode data
+    medicine_info = get_medicine_info_from_barcode(barcode_data, barcode_type)
+    
+    return {
+        "medicineName": medicine_info.get("medicineName", ""),
+        "price": medicine_info.get("price", ""),
+        "manufacturingDate": medicine_info.get("manufacturingDate", ""),
+        "expiryDate": medicine_info.get("expiryDate", ""),
+        "batchNumber": medicine_info.get("batchNumber", ""),
+        "quantity": medicine_info.get("quantity", ""),
+        "barcodeData": barcode_data,
+        "barcodeType": barcode_type
+    }
+
 def get_medicine_info_from_barcode(barcode_data: str, barcode_type: str) -> dict:
     """
     Get medicine information from barcode data.
     This function can be enhanced to use various APIs or databases.
     """
-    medicine_info = {
-        "medicineName": "",
-        "price": "",
-        "manufacturingDate": "",
-        "expiryDate": "",
-        "batchNumber": "",
-        "quantity": ""
-    }
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
     
     # Try different approaches based on barcode type
     if barcode_type in ['EAN13', 'EAN8', 'UPCA', 'UPCE']:
@@ -159,57 +303,58 @@ def get_product_info_from_upc_database(barcode_data: str) -> dict:
     - UPC Database API
     - Barcode Spider API
     """
-    medicine_info = {
-        "medicineName": "",
-        "price": "",
-        "manufacturingDate": "",
-        "expiryDate": "",
-        "batchNumber": "",
-        "quantity": ""
-    }
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
     
     try:
-        # Example using UPC Database API (you'll need to sign up for an API key)
-        api_key = os.getenv("UPC_DATABASE_API_KEY")
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Accept": "application/json"
-        }
-        url = f"https://api.upcitemdb.com/prod/trial/lookup?upc={barcode_data}"
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        # For now, we'll use a mock implementation
-        # In production, implement actual API calls
-        
-        # You can also try OpenFoodFacts for some products
-        # url = f"https://world.openfoodfacts.org/api/v0/product/{barcode_data}.json"
-        # response = requests.get(url, timeout=5)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('status') == 1:
-                product = data.get('product', {})
-                medicine_info["medicineName"] = product.get('product_name', '')
-                # OpenFoodFacts doesn't typically have medicine data, but it's an example
-        
+        medicine_info = dict(_upc_lookup(barcode_data))
     except Exception as e:
         print(f"Error fetching from UPC database: {e}")
     
     return medicine_info
 
+@lru_cache(maxsize=4096)
+def _upc_lookup(barcode_data: str) -> tuple:
+    """
+    Cached UPC lookup, returned as a hashable tuple of items.
+    Request failures raise instead of returning, so they are never cached.
+    """
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
+
+    # Example using UPC Database API (you'll need to sign up for an API key)
+    api_key = os.getenv("UPC_DATABASE_API_KEY")
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Accept": "application/json"
+    }
+    url = f"https://api.upcitemdb.com/prod/trial/lookup?upc={barcode_data}"
+    response = _upc_session.get(url, headers=headers, timeout=(2, 5))
+    
+    # For now, we'll use a mock implementation
+    # In production, implement actual API calls
+    
+    # You can also try OpenFoodFacts for some products
+    # url = f"https://world.openfoodfacts.org/api/v0/product/{barcode_data}.json"
+    # response = requests.get(url, timeout=5)
+    
+    # Unknown codes are cached as empty; rate limits and server errors are not
+    if response.status_code not in (200, 404):
+        response.raise_for_status()
+
+    if response.status_code == 200:
+        data = response.json()
+        if data.get('status') == 1:
+            product = data.get('product', {})
+            medicine_info["medicineName"] = product.get('product_name', '')
+            # OpenFoodFacts doesn't typically have medicine data, but it's an example
+    
+    return tuple(medicine_info.items())
+
 def parse_code128_medicine_data(barcode_data: str) -> dict:
     """
     Parse CODE128 barcode data for medicine information.
     This is often used for custom encoding of medicine data.
     """
-    medicine_info = {
-        "medicineName": "",
-        "price": "",
-        "manufacturingDate": "",
-        "expiryDate": "",
-        "batchNumber": "",
-        "quantity": ""
-    }
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
     
     # Example parsing logic - adjust based on your barcode format
     # Many medicine barcodes follow GS1 standards
@@ -224,14 +369,7 @@ def parse_datamatrix_medicine_data(barcode_data: str) -> dict:
     Parse DataMatrix barcode data for medicine information.
     DataMatrix is commonly used for pharmaceuticals and can contain rich data.
     """
-    medicine_info = {
-        "medicineName": "",
-        "price": "",
-        "manufacturingDate": "",
-        "expiryDate": "",
-        "batchNumber": "",
-        "quantity": ""
-    }
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
     
     # DataMatrix often contains structured data
     # Example format: "01{GTIN}17{EXPIRY}10{BATCH}21{SERIAL}"
@@ -245,26 +383,10 @@ def parse_gs1_barcode(barcode_data: str) -> dict:
     Parse GS1 standard barcode data.
     GS1 Application Identifiers (AI) are used in pharmaceutical barcoding.
     """
-    medicine_info = {
-        "medicineName": "",
-        "price": "",
-        "manufacturingDate": "",
-        "expiryDate": "",
-        "batchNumber": "",
-        "quantity": ""
-    }
-    
-    # GS1 Application Identifiers
-    gs1_patterns = {
-        r'01(\d{14})': 'gtin',           # GTIN
-        r'17(\d{6})': 'expiry',          # Expiry date (YYMMDD)
-        r'10([^\\x1D]+)': 'batch',       # Batch/Lot number
-        r'21([^\\x1D]+)': 'serial',      # Serial number
-        r'30(\d+)': 'quantity'           # Quantity
-    }
+    medicine_info = dict(_EMPTY_MEDICINE_INFO)
     
-    for pattern, field in gs1_patterns.items():
-        match = re.search(pattern, barcode_data)
+    for pattern, field in _GS1_PATTERNS:
+        match = pattern.search(barcode_data)
         if match:
             value = match.group(1)
             if field == 'expiry':